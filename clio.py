@@ -1,54 +1,216 @@
+import sys
+import threading
+from array import array
+from contextlib import contextmanager
 from ctypes import *
 
 cliodb = cdll.LoadLibrary("cliodb-ffi/target/debug/libcliodbffi.so")
 
-cliodb.connect.argtypes = [c_char_p, c_void_p]
+# Declare the full prototype of every entry point we call so that
+# ctypes converts arguments with the fixed per-type converters instead
+# of guessing from the Python objects on each call. c_char_p is only
+# used for arguments: strings coming back from Rust are (pointer,
+# length) pairs in a CValue, decoded in one step by _decode_utf8, since
+# a c_char_p restype would first copy each one into a bytes object.
+cliodb.connect.argtypes = [c_char_p, c_char_p, POINTER(c_void_p)]
 cliodb.connect.restype = c_int
 
+cliodb.get_db.argtypes = [c_void_p, POINTER(c_void_p)]
+cliodb.get_db.restype = c_int
+
+cliodb.drop_db.argtypes = [c_void_p]
+cliodb.drop_db.restype = c_int
+
+cliodb.close.argtypes = [c_void_p]
+cliodb.close.restype = None
+
 cliodb.transact.argtypes = [c_void_p, c_char_p]
 cliodb.transact.restype = c_int
 
+cliodb.transact_many.argtypes = [c_void_p, POINTER(c_char_p), c_size_t]
+cliodb.transact_many.restype = c_int
+
+# Build str objects straight from the (pointer, length) slices handed
+# back by Rust: no strlen and no intermediate bytes object.
+_decode_utf8 = pythonapi.PyUnicode_DecodeUTF8
+_decode_utf8.argtypes = [c_void_p, c_ssize_t, c_char_p]
+_decode_utf8.restype = py_object
+
+def _utf8(s):
+    """Returns s encoded as UTF-8 for passing to Rust. bytes are passed
+    through as-is, so callers that already hold encoded input skip the
+    encode and the extra copy."""
+    return s if isinstance(s, bytes) else s.encode('utf-8')
+
 # ValueTag enum
-(VAL_ENTITY, VAL_IDENT, VAL_STRING, VAL_TIMESTAMP) = (0, 1, 2, 3)
+(VAL_ENTITY, VAL_IDENT, VAL_STRING, VAL_TIMESTAMP, VAL_BOOLEAN, VAL_LONG) = (0, 1, 2, 3, 4, 5)
+# An ident from the schema, passed as its entity id in int_val; see
+# Db.idents.
+VAL_IDENT_ID = 6
 
 class CValue(Structure):
     _fields_ = [
         ("tag", c_int64),
-        ("string_val", c_char_p),
+        ("string_ptr", c_void_p),
+        ("string_len", c_size_t),
         ("int_val", c_int64)
     ]
 
-    def value(self):
-        if self.tag == VAL_ENTITY:
-            return self.int_val
-        elif self.tag == VAL_IDENT:
-            # TODO: return an interned ident type
-            return self.string_val.decode()
-        elif self.tag == VAL_STRING:
-            return self.string_val.decode()
-        elif self.tag == VAL_TIMESTAMP:
-            # TODO: return a real timestamp
-            return self.string_val.decode()
-        else:
-            pass
-          #  raise Exception("Unsupported tag: {}".format(self.tag))
+# Result buffers are read as a packed array of int64 words, one CValue
+# every _CVALUE_WORDS words, instead of through a ctypes Structure (and
+# its field descriptors) per cell. These are the word offsets of each
+# field within a value.
+_CVALUE_WORDS = sizeof(CValue) // sizeof(c_int64)
+(_TAG, _STRING_PTR, _STRING_LEN, _INT_VAL) = (
+    getattr(CValue, name).offset // sizeof(c_int64)
+    for name in ("tag", "string_ptr", "string_len", "int_val")
+)
+
+def _field(words, field, start=0, step=1):
+    """Returns a memoryview of one field of every step-th value, starting
+    at value start, in a packed CValue buffer."""
+    return words[start * _CVALUE_WORDS + field::step * _CVALUE_WORDS]
+
+def _string(string_ptr, string_len):
+    return _decode_utf8(string_ptr, string_len, None)
+
+def _interned_string(string_ptr, string_len, decoded):
+    """Decodes a low-cardinality string (an ident or timestamp). Rust
+    hands back equal ones as the same pointer within a result, so
+    `decoded` maps pointers to strings already built for it."""
+    s = decoded.get(string_ptr)
+    if s is None:
+        s = decoded[string_ptr] = sys.intern(_string(string_ptr, string_len))
+    return s
+
+# Decoders for each value tag. Each takes the cell's (string_ptr,
+# string_len, int_val), the `decoded` dict shared by all cells of one
+# result (see `_interned_string`), and the Db the result came from.
+
+def _decode_int(string_ptr, string_len, int_val, decoded, db):
+    return int_val
+
+def _decode_interned_string(string_ptr, string_len, int_val, decoded, db):
+    # TODO: return an interned ident type for idents, and a real
+    # timestamp for timestamps
+    return _interned_string(string_ptr, string_len, decoded)
+
+def _decode_string(string_ptr, string_len, int_val, decoded, db):
+    return _string(string_ptr, string_len)
+
+def _decode_boolean(string_ptr, string_len, int_val, decoded, db):
+    return int_val != 0
 
-ROW_CALLBACK = CFUNCTYPE(None, c_int32, POINTER(CValue))
+def _decode_ident_id(string_ptr, string_len, int_val, decoded, db):
+    return db.idents()[int_val]
 
-def print_row(num_cols, c_val_p):
-    row = []
-    for i in range(num_cols):
-        row.append(c_val_p[i].value())
-    print(row)
+# Indexed by tag, so decoding a cell is one lookup instead of a chain
+# of comparisons.
+_DECODERS = (
+    _decode_int,                # VAL_ENTITY
+    _decode_interned_string,    # VAL_IDENT
+    _decode_string,             # VAL_STRING
+    _decode_interned_string,    # VAL_TIMESTAMP
+    _decode_boolean,            # VAL_BOOLEAN
+    _decode_int,                # VAL_LONG
+    _decode_ident_id,           # VAL_IDENT_ID
+)
 
-cliodb.query.argtypes = [c_void_p, c_char_p, ROW_CALLBACK]
+def _values(words, start=0, step=1, db=None):
+    """Decodes every step-th value, starting at value start, in a packed
+    CValue buffer that came from db."""
+    # Start from the int_val fields, which come out as a list of exactly
+    # the right size that already holds the value of every entity cell,
+    # and decode the remaining cells in place.
+    values = _field(words, _INT_VAL, start, step).tolist()
+    tags = _field(words, _TAG, start, step).tolist()
+    decoded = {}
+    for i, tag in enumerate(tags):
+        if tag != VAL_ENTITY:
+            offset = (start + i * step) * _CVALUE_WORDS
+            values[i] = _DECODERS[tag](words[offset + _STRING_PTR], words[offset + _STRING_LEN],
+                                       values[i], decoded, db)
+    return values
+
+@contextmanager
+def _packed_values(values_ptr, num_values):
+    """Yields an int64 memoryview over num_values CValues returned by
+    Rust, freeing them with cliodb_free_rows afterwards."""
+    try:
+        buf = cast(values_ptr, POINTER(c_int64 * (num_values * _CVALUE_WORDS))).contents
+        with memoryview(buf).cast('B').cast('q') as words:
+            yield words
+    finally:
+        cliodb.cliodb_free_rows(values_ptr, num_values)
+
+cliodb.cliodb_free_rows.argtypes = [POINTER(CValue), c_size_t]
+cliodb.cliodb_free_rows.restype = None
+
+cliodb.cliodb_intern_table.argtypes = [c_void_p, POINTER(POINTER(CValue)), POINTER(c_size_t)]
+cliodb.cliodb_intern_table.restype = c_int
+
+cliodb.cliodb_query_open_stmt.argtypes = [
+    c_void_p, c_void_p, POINTER(c_char_p), POINTER(CValue), c_size_t,
+    POINTER(c_void_p), POINTER(c_size_t)
+]
+cliodb.cliodb_query_open_stmt.restype = c_int
+
+cliodb.cliodb_query_next.argtypes = [c_void_p, c_void_p, c_size_t]
+cliodb.cliodb_query_next.restype = c_size_t
+
+cliodb.cliodb_query_close.argtypes = [c_void_p]
+cliodb.cliodb_query_close.restype = None
+
+cliodb.cliodb_prepare.argtypes = [c_char_p, POINTER(c_void_p)]
+cliodb.cliodb_prepare.restype = c_int
+
+cliodb.cliodb_query_stmt.argtypes = [
+    c_void_p, c_void_p, POINTER(c_char_p), POINTER(CValue), c_size_t,
+    POINTER(POINTER(CValue)), POINTER(c_size_t), POINTER(c_size_t)
+]
+cliodb.cliodb_query_stmt.restype = c_int
+
+cliodb.cliodb_drop_stmt.argtypes = [c_void_p]
+cliodb.cliodb_drop_stmt.restype = None
+
+# Rows copied out of Rust per cliodb_query_next call by Query.each.
+CURSOR_BATCH_ROWS = 4096
 
 class Db(object):
     def __init__(self, db_ptr):
         self.db_ptr = db_ptr
+        self._idents = None
+
+    # drop_db is bound as a default argument because module globals may
+    # already be torn down when this runs during interpreter shutdown.
+    def __del__(self, _drop_db=cliodb.drop_db):
+        _drop_db(self.db_ptr)
+
+    def idents(self):
+        """Returns a dict mapping entity ids to names for every ident in
+        the schema, which queries return as ids (VAL_IDENT_ID) instead of
+        strings. Fetched from Rust once per Db."""
+        if self._idents is None:
+            values_ptr = POINTER(CValue)()
+            num_idents = c_size_t()
+            err = cliodb.cliodb_intern_table(self.db_ptr, byref(values_ptr), byref(num_idents))
+            if err < 0:
+                # TODO: Set an error string
+                raise Exception("Error reading idents")
+
+            # The table is a flat array of (entity, ident) pairs.
+            with _packed_values(values_ptr, 2 * num_idents.value) as words:
+                ids = _field(words, _INT_VAL, 0, 2).tolist()
+                names = _values(words, 1, 2)
+            self._idents = dict(zip(ids, names))
+
+        return self._idents
 
-    def __del__(self):
-        cliodb.drop_db(self.db_ptr)
+    def decode_idents(self, ids):
+        """Maps a column of ident ids, as returned by Query.columns with
+        raw_ident_ids, to their names."""
+        idents = self.idents()
+        return [idents[i] for i in ids]
 
 class ClioDB(object):
     def __init__(self, store_uri, tx_uri):
@@ -58,41 +220,212 @@ class ClioDB(object):
         if not tx_uri:
             raise Exception("tx_uri must be provided")
         self.conn_ptr = c_void_p()
-        cliodb.connect(store_uri.encode('utf-8'), tx_uri.encode('utf-8'), byref(self.conn_ptr))
-
-    def db(self):
-        db_ptr = c_void_p()
-        err = cliodb.get_db(self.conn_ptr, byref(db_ptr))
+        err = cliodb.connect(_utf8(store_uri), _utf8(tx_uri), byref(self.conn_ptr))
         if err < 0:
             # TODO: Set an error string
-            raise Exception("Error opening db")
-        return Db(db_ptr)
+            raise Exception("Error connecting to {}".format(store_uri))
+
+        # Out-parameter for get_db, reused by every call to db() rather
+        # than allocating a c_void_p and a byref() each time.
+        self._db_out = c_void_p()
+        self._db_out_ref = byref(self._db_out)
+
+        # Functions loaded through cdll release the GIL for the duration
+        # of the call, so other Python threads keep running while Rust
+        # executes a query or transaction. get_db takes the connection
+        # mutably (and writes to the shared _db_out), so every call that
+        # uses the connection holds _conn_lock. Queries only use a Db, so
+        # they don't take it; see Query for what a Query shares between
+        # threads.
+        self._conn_lock = threading.Lock()
+
+    def db(self):
+        with self._conn_lock:
+            err = cliodb.get_db(self.conn_ptr, self._db_out_ref)
+            if err < 0:
+                # TODO: Set an error string
+                raise Exception("Error opening db")
+            return Db(self._db_out.value)
 
     def transact(self, tx_string):
-        tx_bytes = tx_string.encode('utf-8')
-        ret = cliodb.transact(self.conn_ptr, tx_bytes)
+        tx_bytes = _utf8(tx_string)
+        with self._conn_lock:
+            ret = cliodb.transact(self.conn_ptr, tx_bytes)
         if ret < 0:
             # TODO: Set an error string
             print("return value {}".format(ret))
             raise Exception("Error executing transaction")
 
+    def transact_many(self, tx_strings):
+        """Transacts every string in tx_strings with a single FFI call.
+        They are committed in groups of up to 1024 per transaction, so an
+        error can leave earlier groups committed."""
+        tx_bytes = [_utf8(tx_string) for tx_string in tx_strings]
+        tx_array = (c_char_p * len(tx_bytes))(*tx_bytes)
+        with self._conn_lock:
+            ret = cliodb.transact_many(self.conn_ptr, tx_array, len(tx_bytes))
+        if ret < 0:
+            # TODO: Set an error string
+            raise Exception("Error executing transaction")
+
     def close(self):
-        cliodb.close(self.conn_ptr)
+        with self._conn_lock:
+            cliodb.close(self.conn_ptr)
 
 
+class Long(int):
+    """Marks an int query parameter as a long value rather than an
+    entity id, e.g. Query(...).run(db, age=Long(42))."""
+
+def _params(params):
+    """Converts a dict of query parameters into the name and CValue arrays
+    passed to cliodb_query_stmt. Also returns the encoded strings the
+    values point into, which must be kept alive until the call returns."""
+    names = (c_char_p * len(params))()
+    values = (CValue * len(params))()
+    encoded = []
+    for i, (name, value) in enumerate(params.items()):
+        names[i] = _utf8(name)
+        if isinstance(value, bool):
+            values[i].tag = VAL_BOOLEAN
+            values[i].int_val = value
+        elif isinstance(value, Long):
+            values[i].tag = VAL_LONG
+            values[i].int_val = value
+        elif isinstance(value, int):
+            values[i].tag = VAL_ENTITY
+            values[i].int_val = value
+        elif isinstance(value, (str, bytes)):
+            value = _utf8(value)
+            encoded.append(value)
+            values[i].tag = VAL_STRING
+            values[i].string_ptr = cast(value, c_void_p).value
+            values[i].string_len = len(value)
+        else:
+            raise TypeError("Unsupported parameter type: {}".format(type(value)))
+
+    return names, values, encoded
+
 class Query(object):
-    # TODO: queries should be parameterizable
+    """A query, which is parsed once and can then be run any number of
+    times. Vars in the query (without the leading ?) can be bound by
+    passing a dict mapping their names to values as the params argument
+    of run, each or columns: ints are bound as entity ids, Longs as
+    longs, bools as booleans and strs as strings."""
 
     def __init__(self, query_string):
-        self.query_string = query_string.encode('utf-8')
-
-    def run(self, db):
-        self.results = []
-        def row_cb(num_cols, row_ptr):
-            row = []
-            for i in range(num_cols):
-                row.append(row_ptr[i].value())
-            self.results.append(row)
-
-        cliodb.query(db.db_ptr, self.query_string, ROW_CALLBACK(row_cb))
-        return self.results
+        # Set before anything that can raise, since __del__ reads it.
+        self.stmt_ptr = None
+        self.query_string = _utf8(query_string)
+        # The statement is prepared on first use. The same Query may be
+        # run from several threads at once, so this keeps two of them
+        # from both preparing it and leaking one of the statements.
+        self._stmt_lock = threading.Lock()
+
+    def __del__(self, _drop_stmt=cliodb.cliodb_drop_stmt):
+        if self.stmt_ptr is not None:
+            _drop_stmt(self.stmt_ptr)
+
+    def _stmt(self):
+        with self._stmt_lock:
+            if self.stmt_ptr is None:
+                stmt_ptr = c_void_p()
+                err = cliodb.cliodb_prepare(self.query_string, byref(stmt_ptr))
+                if err < 0:
+                    # TODO: Set an error string
+                    raise Exception("Error parsing query")
+                self.stmt_ptr = stmt_ptr
+            return self.stmt_ptr
+
+    @contextmanager
+    def _query_all(self, db, params):
+        """Runs the query and yields (words, num_rows, width), where words
+        is an int64 memoryview over the flat, row-major array of result
+        values. It is only valid inside the with block."""
+        rows_ptr = POINTER(CValue)()
+        num_rows = c_size_t()
+        width = c_size_t()
+        params = params or {}
+        names, values, encoded = _params(params)
+        err = cliodb.cliodb_query_stmt(
+            db.db_ptr, self._stmt(), names, values, len(params),
+            byref(rows_ptr), byref(num_rows), byref(width)
+        )
+        if err < 0:
+            # TODO: Set an error string
+            raise Exception("Error executing query")
+
+        num_rows, width = num_rows.value, width.value
+        with _packed_values(rows_ptr, num_rows * width) as words:
+            yield words, num_rows, width
+
+    def run(self, db, params=None):
+        # All rows come back in one flat array; slice it into rows here
+        # instead of crossing the FFI once per row.
+        with self._query_all(db, params) as (words, num_rows, width):
+            cells = _values(words, db=db)
+
+        # Return the local list rather than self.results, which another
+        # thread running this query may already have replaced.
+        results = [cells[i * width:(i + 1) * width] for i in range(num_rows)]
+        self.results = results
+        return results
+
+    def each(self, db, fn, params=None):
+        """Runs the query, calling fn(row) for each result row. Rows are
+        copied out of Rust CURSOR_BATCH_ROWS at a time into one reused
+        buffer, instead of all at once or one callback per row."""
+        cursor = c_void_p()
+        width = c_size_t()
+        params = params or {}
+        names, values, encoded = _params(params)
+        err = cliodb.cliodb_query_open_stmt(
+            db.db_ptr, self._stmt(), names, values, len(params),
+            byref(cursor), byref(width)
+        )
+        if err < 0:
+            # TODO: Set an error string
+            raise Exception("Error executing query")
+
+        width = width.value
+        buf = (c_int64 * (CURSOR_BATCH_ROWS * width * _CVALUE_WORDS))()
+        try:
+            with memoryview(buf).cast('B').cast('q') as words:
+                while True:
+                    num_rows = cliodb.cliodb_query_next(cursor, buf, CURSOR_BATCH_ROWS)
+                    if num_rows == 0:
+                        break
+                    cells = _values(words[:num_rows * width * _CVALUE_WORDS], db=db)
+                    for i in range(num_rows):
+                        fn(cells[i * width:(i + 1) * width])
+        finally:
+            cliodb.cliodb_query_close(cursor)
+
+    def columns(self, db, params=None, raw_ident_ids=False):
+        """Runs the query and returns one column per find variable, in
+        order. Each column holds the same values run would return for
+        it; columns holding only entities are packed into an array('q')
+        instead of a list of boxed ints.
+
+        With raw_ident_ids, columns holding idents are instead returned
+        as an array('q') of their ids, without looking up their names;
+        see Db.decode_idents. Every value in such a column must be an
+        ident from the schema, or ValueError is raised."""
+        columns = []
+        with self._query_all(db, params) as (words, num_rows, width):
+            for i in range(width):
+                tags = _field(words, _TAG, i, width).tolist()
+                if raw_ident_ids and (VAL_IDENT_ID in tags or VAL_IDENT in tags):
+                    if tags.count(VAL_IDENT_ID) != num_rows:
+                        raise ValueError(
+                            "Column {} holds values other than schema idents".format(i))
+                    int_vals = _field(words, _INT_VAL, i, width)
+                    columns.append(array('q', int_vals.tobytes()))
+                elif tags.count(VAL_ENTITY) == num_rows:
+                    # Copy the int_val fields straight out of the buffer.
+                    int_vals = _field(words, _INT_VAL, i, width)
+                    columns.append(array('q', int_vals.tobytes()))
+                else:
+                    columns.append(_values(words, i, width, db))
+
+        return columns
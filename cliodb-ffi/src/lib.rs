@@ -1,11 +1,19 @@
 extern crate cliodb;
 extern crate zmq;
 
-use std::ffi::{CStr, CString};
+#[cfg(test)]
+extern crate chrono;
+
+use std::cmp;
+use std::collections::{HashMap, HashSet};
+use std::ffi::CStr;
 use std::mem;
+use std::ptr;
+use std::slice;
+use std::str;
 use std::os::raw::{c_char, c_int, c_long};
 
-use cliodb::{Result, Value, Relation, TxReport};
+use cliodb::{Error, Query, Result, Value, Relation, Tx, TxReport};
 use cliodb::conn::{Conn, store_from_uri};
 use cliodb::db::Db;
 
@@ -65,7 +73,7 @@ pub extern "C" fn close(conn: *mut Conn) {
 }
 
 #[repr(u64)]
-#[derive(Debug, Clone)]
+#[derive(Debug, Clone, PartialEq)]
 pub enum ValueTag {
     Entity = 0,
     Ident = 1,
@@ -73,6 +81,9 @@ pub enum ValueTag {
     Timestamp = 3,
     Boolean = 4,
     Long = 5,
+    /// An ident registered in the schema, passed as the id of its
+    /// entity in `int_val`. See `cliodb_intern_table`.
+    IdentId = 6,
 }
 
 impl<'a> From<&'a Value> for CValue {
@@ -80,8 +91,8 @@ impl<'a> From<&'a Value> for CValue {
         match *v {
             Value::String(ref s) => CValue::string(s),
             Value::Ref(cliodb::Entity(e)) => CValue::entity(e),
-            Value::Ident(ref i) => CValue::string(i),
-            Value::Timestamp(t) => CValue::string(&t.to_string()),
+            Value::Ident(ref i) => CValue::with_string(ValueTag::Ident, i),
+            Value::Timestamp(t) => CValue::with_string(ValueTag::Timestamp, &t.to_string()),
             Value::Boolean(b) => CValue::boolean(b),
             Value::Long(l) => CValue::long(l),
         }
@@ -92,18 +103,28 @@ impl<'a> From<&'a Value> for CValue {
 #[derive(Debug, Clone)]
 pub struct CValue {
     tag: ValueTag,
-    string_val: *const c_char,
+    // Strings are passed as a (pointer, length) slice of UTF-8 bytes,
+    // so callers can decode them without scanning for a terminator.
+    // Non-string values have a null `string_ptr`.
+    string_ptr: *const u8,
+    string_len: usize,
     int_val: c_long,
 }
 
 // These functions are leaky to facilitate passing the resulting
-// structs over the FFI.  You MUST reclaim the string_val field with
-// `CString::from_raw` in order to avoid a memory leak.
+// structs over the FFI.  You MUST reclaim the string with
+// `CValue::free_string` in order to avoid a memory leak.
 impl CValue {
     fn string(val: &str) -> CValue {
+        CValue::with_string(ValueTag::String, val)
+    }
+
+    fn with_string(tag: ValueTag, val: &str) -> CValue {
+        let bytes: Box<[u8]> = val.as_bytes().into();
         CValue {
-            tag: ValueTag::String,
-            string_val: CString::new(val).unwrap().into_raw(),
+            tag: tag,
+            string_len: bytes.len(),
+            string_ptr: Box::into_raw(bytes) as *const u8,
             int_val: 0,
         }
     }
@@ -111,7 +132,8 @@ impl CValue {
     fn entity(val: i64) -> CValue {
         CValue {
             tag: ValueTag::Entity,
-            string_val: CString::default().into_raw(),
+            string_ptr: ptr::null(),
+            string_len: 0,
             int_val: val as c_long,
         }
     }
@@ -119,63 +141,360 @@ impl CValue {
     fn boolean(val: bool) -> CValue {
         CValue {
             tag: ValueTag::Boolean,
-            string_val: CString::default().into_raw(),
+            string_ptr: ptr::null(),
+            string_len: 0,
             int_val: if val { 1 } else { 0 },
         }
     }
 
+    fn ident_id(val: i64) -> CValue {
+        CValue {
+            tag: ValueTag::IdentId,
+            string_ptr: ptr::null(),
+            string_len: 0,
+            int_val: val as c_long,
+        }
+    }
+
     fn long(val: i64) -> CValue {
         CValue {
-            tag: ValueTag::Entity,
-            string_val: CString::default().into_raw(),
+            tag: ValueTag::Long,
+            string_ptr: ptr::null(),
+            string_len: 0,
             int_val: val as c_long,
         }
     }
+
+    /// Converts a value passed in by the caller, such as a query
+    /// parameter, back into a `Value`.
+    unsafe fn to_value(&self) -> Result<Value> {
+        match self.tag {
+            ValueTag::Entity => Ok(Value::Ref(cliodb::Entity(self.int_val as i64))),
+            ValueTag::String => Ok(Value::String(self.str()?.to_string())),
+            ValueTag::Ident => Ok(Value::Ident(self.str()?.to_string())),
+            ValueTag::Boolean => Ok(Value::Boolean(self.int_val != 0)),
+            ValueTag::Long => Ok(Value::Long(self.int_val as i64)),
+            ref tag => Err(format!("unsupported value type {:?}", tag).into()),
+        }
+    }
+
+    unsafe fn str(&self) -> Result<&str> {
+        let bytes = slice::from_raw_parts(self.string_ptr, self.string_len);
+        Ok(str::from_utf8(bytes)?)
+    }
+
+    unsafe fn free_string(&self) {
+        if !self.string_ptr.is_null() {
+            let bytes = slice::from_raw_parts_mut(self.string_ptr as *mut u8, self.string_len);
+            let _ = Box::from_raw(bytes as *mut [u8]);
+        }
+    }
 }
 
-#[no_mangle]
-pub extern "C" fn query(
-    db_ptr: *mut Db,
-    query_string_ptr: *const c_char,
-    cb: extern "C" fn(num_items: c_int, row: *const CValue),
+fn tx_from_c_string(tx_str: &CStr) -> Result<Tx> {
+    Ok(cliodb::parse_tx(tx_str.to_str()?)?)
+}
+
+/// Writes the result of a query to the out-parameters of
+/// `cliodb_query_stmt`.
+fn return_rows(
+    db: &Db,
+    result: Result<Relation>,
+    out_rows: *mut *mut CValue,
+    out_len: *mut usize,
+    out_width: *mut usize,
 ) -> c_int {
-    let db: &Db = unsafe { &*db_ptr };
+    match result {
+        Ok(Relation(vars, rows)) => {
+            let values = flatten_rows(&|name: &str| schema_ident_id(db, name), &rows);
+            unsafe {
+                *out_len = rows.len();
+                *out_width = vars.len();
+                *out_rows = Box::into_raw(values) as *mut CValue;
+            }
+            return 0;
+        }
+        Err(e) => {
+            // FIXME: implement a more robust way to retrieve error msgs
+            println!("error {:?}", e);
+            return -1;
+        }
+    }
+}
+
+/// A query parsed once by `cliodb_prepare`, which can then be run any
+/// number of times, with different parameters, by `cliodb_query_stmt`.
+pub struct Statement {
+    query: Query,
+}
+
+/// Parses a query into a statement, written to `out_stmt`. Vars in the
+/// query can be bound to values each time it is run.
+///
+/// The statement MUST be released with `cliodb_drop_stmt`.
+#[no_mangle]
+pub extern "C" fn cliodb_prepare(query_string_ptr: *const c_char, out_stmt: *mut *mut Statement) -> c_int {
     let query_str = unsafe { CStr::from_ptr(query_string_ptr) };
-    let q = match cliodb::parse_query(query_str.to_str().unwrap()) {
-        Ok(q) => q,
-        Err(err) => {
+    let parsed = query_str.to_str()
+        .map_err(Error::from)
+        .and_then(|s| cliodb::parse_query(s).map_err(Error::from));
+
+    match parsed {
+        Ok(query) => {
+            unsafe { *out_stmt = Box::into_raw(Box::new(Statement { query })) };
+            return 0;
+        }
+        Err(e) => {
             // FIXME: implement a more robust way to retrieve error msgs
-            println!("error {}", err);
+            println!("error {:?}", e);
             return -1;
         }
-    };
+    }
+}
+
+/// Runs a prepared statement with the vars named in `param_names`
+/// bound to the corresponding values in `params`, both of length
+/// `num_params`. Every result row is handed back at once, as a single
+/// flat array of `out_len * out_width` values in row-major order.
+///
+/// The array MUST be released with `cliodb_free_rows`.
+#[no_mangle]
+pub extern "C" fn cliodb_query_stmt(
+    db_ptr: *mut Db,
+    stmt_ptr: *const Statement,
+    param_names: *const *const c_char,
+    params: *const CValue,
+    num_params: usize,
+    out_rows: *mut *mut CValue,
+    out_len: *mut usize,
+    out_width: *mut usize,
+) -> c_int {
+    let db: &Db = unsafe { &*db_ptr };
+    let stmt: &Statement = unsafe { &*stmt_ptr };
+    let result = unsafe { run_stmt(db, stmt, param_names, params, num_params) };
+
+    return_rows(db, result, out_rows, out_len, out_width)
+}
+
+/// Binds the `num_params` parameters passed to `cliodb_query_stmt` or
+/// `cliodb_query_open_stmt` and runs the statement.
+unsafe fn run_stmt(
+    db: &Db,
+    stmt: &Statement,
+    param_names: *const *const c_char,
+    params: *const CValue,
+    num_params: usize,
+) -> Result<Relation> {
+    let bindings = param_bindings(param_names, params, num_params)?;
+    cliodb::query(stmt.query.bind(bindings)?, db)
+}
+
+/// Pairs up the names and values of `num_params` query parameters.
+unsafe fn param_bindings<'a>(
+    param_names: *const *const c_char,
+    params: *const CValue,
+    num_params: usize,
+) -> Result<Vec<(&'a str, Value)>> {
+    let names = slice::from_raw_parts(param_names, num_params);
+    let params = slice::from_raw_parts(params, num_params);
+
+    names.iter().zip(params.iter())
+        .map(|(&name, param)| -> Result<(&str, Value)> {
+            let name = CStr::from_ptr(name).to_str()?;
+            Ok((name, param.to_value()?))
+        })
+        .collect()
+}
+
+#[no_mangle]
+/// Drops a statement created by `cliodb_prepare`.
+pub extern "C" fn cliodb_drop_stmt(stmt: *mut Statement) {
+    unsafe {
+        let _ = Box::from_raw(stmt);
+    }
+}
+
+/// Builds the flat value array returned by `cliodb_query_stmt`. Idents
+/// registered in the schema are passed as ids (see `ValueTag::IdentId`)
+/// rather than strings. Other idents and timestamps tend to repeat from
+/// row to row, so equal ones share a single string allocation; callers
+/// can use the pointer to recognize values they have already decoded.
+///
+/// `ident_id` looks up the id of an ident in the schema; see
+/// `schema_ident_id`.
+fn flatten_rows(ident_id: &dyn Fn(&str) -> Option<i64>, rows: &[Vec<Value>]) -> Box<[CValue]> {
+    let mut shared: HashMap<&Value, CValue> = HashMap::new();
+    let mut values = Vec::with_capacity(rows.iter().map(|row| row.len()).sum());
+
+    for v in rows.iter().flat_map(|row| row.iter()) {
+        let cval = match *v {
+            Value::Ident(ref i) => match ident_id(i) {
+                Some(e) => CValue::ident_id(e),
+                None => shared.entry(v).or_insert_with(|| v.into()).clone(),
+            },
+            Value::Timestamp(_) => shared.entry(v).or_insert_with(|| v.into()).clone(),
+            _ => v.into(),
+        };
+        values.push(cval);
+    }
 
-    match cliodb::query(q, &db) {
+    values.into_boxed_slice()
+}
+
+/// Returns the id of `name` if it is an ident in `db`'s schema.
+fn schema_ident_id(db: &Db, name: &str) -> Option<i64> {
+    db.schema.idents.get(name).map(|&cliodb::Entity(e)| e)
+}
+
+/// Builds the flat array of (entity, ident) pairs returned by
+/// `cliodb_intern_table`.
+fn intern_table<'a, I>(idents: I) -> Box<[CValue]>
+where
+    I: IntoIterator<Item = (&'a str, i64)>,
+{
+    let mut values = Vec::new();
+    for (name, e) in idents {
+        values.push(CValue::entity(e));
+        values.push(CValue::with_string(ValueTag::Ident, name));
+    }
+    values.into_boxed_slice()
+}
+
+/// Hands back the schema's idents as a flat array of `out_len`
+/// (entity, ident) pairs, so callers can resolve the `IdentId` values
+/// returned by `cliodb_query_stmt`. Callers only need to fetch it once
+/// per db.
+///
+/// The array MUST be released with `cliodb_free_rows`, passing a length
+/// of `2 * out_len`.
+#[no_mangle]
+pub extern "C" fn cliodb_intern_table(
+    db_ptr: *mut Db,
+    out_rows: *mut *mut CValue,
+    out_len: *mut usize,
+) -> c_int {
+    let db: &Db = unsafe { &*db_ptr };
+    let values = intern_table(
+        db.schema.idents.iter().map(|(name, &cliodb::Entity(e))| (name.as_str(), e))
+    );
+
+    unsafe {
+        *out_len = db.schema.idents.len();
+        *out_rows = Box::into_raw(values) as *mut CValue;
+    }
+    0
+}
+
+/// Frees the strings of values built by `flatten_rows`.
+unsafe fn free_values(values: &[CValue]) {
+    // Values may share a string (see `flatten_rows`), so free each once.
+    let mut freed = HashSet::new();
+    for val in values.iter() {
+        if freed.insert(val.string_ptr) {
+            val.free_string();
+        }
+    }
+}
+
+#[no_mangle]
+/// Frees an array of `len` values returned by `cliodb_query_stmt`,
+/// including the strings they point to.
+pub extern "C" fn cliodb_free_rows(rows: *mut CValue, len: usize) {
+    let values = unsafe { Box::from_raw(slice::from_raw_parts_mut(rows, len) as *mut [CValue]) };
+    unsafe { free_values(&values) };
+}
+
+/// A query result being read out in batches by `cliodb_query_next`.
+pub struct Cursor {
+    /// Looks up schema idents for `flatten_rows`, holding on to the db
+    /// the rows came from.
+    ident_id: Box<dyn Fn(&str) -> Option<i64>>,
+    rows: Vec<Vec<Value>>,
+    next_row: usize,
+    /// The values most recently copied out by `cliodb_query_next`.
+    /// Their strings live until the next call or `cliodb_query_close`.
+    batch: Box<[CValue]>,
+}
+
+impl Cursor {
+    fn new(ident_id: Box<dyn Fn(&str) -> Option<i64>>, rows: Vec<Vec<Value>>) -> Cursor {
+        Cursor {
+            ident_id: ident_id,
+            rows: rows,
+            next_row: 0,
+            batch: Vec::new().into_boxed_slice(),
+        }
+    }
+}
+
+/// Runs a prepared statement, with parameters bound as by
+/// `cliodb_query_stmt`, and returns a cursor over its results in
+/// `out_cursor`, along with the number of values per row in
+/// `out_width`. Rows are then read with `cliodb_query_next` into a
+/// buffer owned by the caller, which can be reused from batch to batch.
+///
+/// The cursor MUST be released with `cliodb_query_close`.
+#[no_mangle]
+pub extern "C" fn cliodb_query_open_stmt(
+    db_ptr: *mut Db,
+    stmt_ptr: *const Statement,
+    param_names: *const *const c_char,
+    params: *const CValue,
+    num_params: usize,
+    out_cursor: *mut *mut Cursor,
+    out_width: *mut usize,
+) -> c_int {
+    let db: &Db = unsafe { &*db_ptr };
+    let stmt: &Statement = unsafe { &*stmt_ptr };
+
+    match unsafe { run_stmt(db, stmt, param_names, params, num_params) } {
         Ok(Relation(vars, rows)) => {
-            for row in rows {
-                let row_vec: Vec<CValue> = row.iter().map(|v| v.into()).collect();
-                cb(vars.len() as i32, row_vec.as_ptr());
-                // Free the CString's value.
-                for val in row_vec {
-                    unsafe {
-                        CString::from_raw(val.string_val as *mut i8);
-                    }
-                }
+            let db = db.clone();
+            let cursor = Cursor::new(Box::new(move |name: &str| schema_ident_id(&db, name)), rows);
+            unsafe {
+                *out_width = vars.len();
+                *out_cursor = Box::into_raw(Box::new(cursor));
             }
             return 0;
         }
         Err(e) => {
+            // FIXME: implement a more robust way to retrieve error msgs
             println!("error {:?}", e);
             return -1;
         }
     }
 }
 
+/// Copies up to `cap` rows from the cursor into `buf`, which must have
+/// room for `cap` times the cursor's width values, and returns the
+/// number of rows copied; 0 means the cursor is exhausted. Strings in
+/// the copied values are only valid until the next call on the cursor.
+#[no_mangle]
+pub extern "C" fn cliodb_query_next(cursor_ptr: *mut Cursor, buf: *mut CValue, cap: usize) -> usize {
+    let cursor: &mut Cursor = unsafe { &mut *cursor_ptr };
+    unsafe { free_values(&cursor.batch) };
+
+    let start = cursor.next_row;
+    let end = cmp::min(start + cap, cursor.rows.len());
+    cursor.batch = flatten_rows(&*cursor.ident_id, &cursor.rows[start..end]);
+    cursor.next_row = end;
+
+    unsafe { ptr::copy_nonoverlapping(cursor.batch.as_ptr(), buf, cursor.batch.len()) };
+    end - start
+}
+
+#[no_mangle]
+/// Drops a cursor created by `cliodb_query_open_stmt`.
+pub extern "C" fn cliodb_query_close(cursor_ptr: *mut Cursor) {
+    let cursor = unsafe { Box::from_raw(cursor_ptr) };
+    unsafe { free_values(&cursor.batch) };
+}
+
 #[no_mangle]
 pub extern "C" fn transact(conn_ptr: *mut Conn, tx_ptr: *const c_char) -> c_int {
     let conn: &Conn = unsafe { &*conn_ptr };
     let tx_str = unsafe { CStr::from_ptr(tx_ptr) };
-    let tx = match cliodb::parse_tx(tx_str.to_str().unwrap()) {
+    let tx = match tx_from_c_string(tx_str) {
         Ok(tx) => tx,
         // FIXME: signal error
         Err(e) => {
@@ -199,3 +518,257 @@ pub extern "C" fn transact(conn_ptr: *mut Conn, tx_ptr: *const c_char) -> c_int
         },
     }
 }
+
+/// Number of transaction strings merged into each transaction sent by
+/// `transact_many`.
+const TRANSACT_BATCH_SIZE: usize = 1024;
+
+/// Parses transaction strings into one transaction per
+/// `TRANSACT_BATCH_SIZE` of them. Each batch is only parsed once the
+/// previous one has been consumed.
+fn tx_batches<'a>(tx_ptrs: &'a [*const c_char]) -> impl Iterator<Item = Result<Tx>> + 'a {
+    tx_ptrs.chunks(TRANSACT_BATCH_SIZE).map(|batch| {
+        let mut items = vec![];
+        for &tx_ptr in batch {
+            let tx_str = unsafe { CStr::from_ptr(tx_ptr) };
+            items.extend(tx_from_c_string(tx_str)?.items);
+        }
+        Ok(Tx { items })
+    })
+}
+
+/// Transacts `n` transaction strings with a single call. The strings
+/// are committed in groups of `TRANSACT_BATCH_SIZE`, each group as one
+/// transaction, so a failure leaves the groups before it committed.
+#[no_mangle]
+pub extern "C" fn transact_many(conn_ptr: *mut Conn, tx_ptrs: *const *const c_char, n: usize) -> c_int {
+    let conn: &Conn = unsafe { &*conn_ptr };
+    let tx_ptrs = unsafe { slice::from_raw_parts(tx_ptrs, n) };
+
+    for tx in tx_batches(tx_ptrs) {
+        let tx = match tx {
+            Ok(tx) => tx,
+            // FIXME: signal error
+            Err(e) => {
+                println!("error {:?}", e);
+                return -1;
+            }
+        };
+
+        match conn.transact(tx) {
+            Ok(TxReport::Success { .. }) => {}
+            // FIXME: Signal error
+            Ok(TxReport::Failure(f)) => {
+                println!("error {:?}", f);
+                return -1;
+            },
+            Err(e) => {
+                println!("error {:?}", e);
+                return -1;
+            },
+        }
+    }
+
+    0
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use chrono::{DateTime, Utc};
+    use cliodb::Entity;
+    use std::ffi::CString;
+
+    fn ident_ids(name: &str) -> Option<i64> {
+        match name {
+            "name" => Some(1),
+            _ => None,
+        }
+    }
+
+    fn free_rows(values: Box<[CValue]>) {
+        let len = values.len();
+        cliodb_free_rows(Box::into_raw(values) as *mut CValue, len);
+    }
+
+    #[test]
+    fn test_flatten_rows_shares_strings() {
+        let ts: DateTime<Utc> = "2020-01-01T00:00:00Z".parse().unwrap();
+        let rows = vec![
+            vec![Value::Ident("color".into()), Value::Timestamp(ts)],
+            vec![Value::Ident("color".into()), Value::Timestamp(ts)],
+            vec![Value::Ident("name".into()), Value::String("Bob".into())],
+        ];
+        let values = flatten_rows(&ident_ids, &rows);
+
+        assert_eq!(values.len(), 6);
+        assert_eq!(values[0].tag, ValueTag::Ident);
+        assert_eq!(values[0].string_ptr, values[2].string_ptr);
+        assert_eq!(values[1].tag, ValueTag::Timestamp);
+        assert_eq!(values[1].string_ptr, values[3].string_ptr);
+        assert_eq!(unsafe { values[2].str() }.unwrap(), "color");
+
+        assert_eq!(values[4].tag, ValueTag::IdentId);
+        assert_eq!(values[4].int_val, 1);
+        assert!(values[4].string_ptr.is_null());
+        assert_eq!(unsafe { values[5].str() }.unwrap(), "Bob");
+
+        free_rows(values);
+    }
+
+    #[test]
+    fn test_flatten_rows_tags() {
+        let rows = vec![vec![Value::Ref(Entity(7)), Value::Long(42), Value::Boolean(true)]];
+        let values = flatten_rows(&ident_ids, &rows);
+
+        assert_eq!(values[0].tag, ValueTag::Entity);
+        assert_eq!(values[0].int_val, 7);
+        assert_eq!(values[1].tag, ValueTag::Long);
+        assert_eq!(values[1].int_val, 42);
+        assert_eq!(values[2].tag, ValueTag::Boolean);
+        assert_eq!(values[2].int_val, 1);
+
+        free_rows(values);
+    }
+
+    #[test]
+    fn test_to_value() {
+        let s = CValue::string("Bob");
+        assert_eq!(unsafe { s.to_value() }.unwrap(), Value::String("Bob".into()));
+        unsafe { s.free_string() };
+
+        let ident = CValue::with_string(ValueTag::Ident, "name");
+        assert_eq!(unsafe { ident.to_value() }.unwrap(), Value::Ident("name".into()));
+        unsafe { ident.free_string() };
+
+        let values = vec![
+            (CValue::entity(11), Value::Ref(Entity(11))),
+            (CValue::boolean(true), Value::Boolean(true)),
+            (CValue::boolean(false), Value::Boolean(false)),
+            (CValue::long(-5), Value::Long(-5)),
+        ];
+        for (cval, expected) in values {
+            assert_eq!(unsafe { cval.to_value() }.unwrap(), expected);
+        }
+
+        // Timestamps and ident ids are only ever returned, not passed in.
+        assert!(unsafe { CValue::ident_id(1).to_value() }.is_err());
+        let mut ts = CValue::string("2020-01-01T00:00:00Z");
+        ts.tag = ValueTag::Timestamp;
+        assert!(unsafe { ts.to_value() }.is_err());
+        unsafe { ts.free_string() };
+    }
+
+    #[test]
+    fn test_param_bindings() {
+        let names = vec![
+            CString::new("a").unwrap(),
+            CString::new("b").unwrap(),
+            CString::new("c").unwrap(),
+        ];
+        let name_ptrs: Vec<*const c_char> = names.iter().map(|n| n.as_ptr()).collect();
+        let params = vec![CValue::string("Bob"), CValue::boolean(true), CValue::long(3)];
+
+        let bindings = unsafe { param_bindings(name_ptrs.as_ptr(), params.as_ptr(), 3) }.unwrap();
+        assert_eq!(bindings, vec![
+            ("a", Value::String("Bob".into())),
+            ("b", Value::Boolean(true)),
+            ("c", Value::Long(3)),
+        ]);
+        assert!(unsafe { param_bindings(name_ptrs.as_ptr(), params.as_ptr(), 0) }.unwrap().is_empty());
+
+        let bad = vec![CValue::string("Bob"), CValue::ident_id(1), CValue::long(3)];
+        assert!(unsafe { param_bindings(name_ptrs.as_ptr(), bad.as_ptr(), 3) }.is_err());
+
+        unsafe {
+            params[0].free_string();
+            bad[0].free_string();
+        }
+    }
+
+    #[test]
+    fn test_tx_batches() {
+        let txs: Vec<CString> = (0..2 * TRANSACT_BATCH_SIZE + 1)
+            .map(|i| CString::new(format!("add ({} name \"Bob\")", i)).unwrap())
+            .collect();
+        let tx_ptrs: Vec<*const c_char> = txs.iter().map(|tx| tx.as_ptr()).collect();
+
+        let sizes: Vec<usize> = tx_batches(&tx_ptrs)
+            .map(|tx| tx.unwrap().items.len())
+            .collect();
+        assert_eq!(sizes, vec![TRANSACT_BATCH_SIZE, TRANSACT_BATCH_SIZE, 1]);
+        assert_eq!(tx_batches(&[]).count(), 0);
+
+        // Invalid UTF-8 is an error, not a panic.
+        let invalid = CString::new(vec![0xff]).unwrap();
+        let mixed = vec![tx_ptrs[0], invalid.as_ptr()];
+        let results: Vec<bool> = tx_batches(&mixed).map(|tx| tx.is_ok()).collect();
+        assert_eq!(results, vec![false]);
+    }
+
+    #[test]
+    fn test_empty_strings() {
+        let rows = vec![
+            vec![Value::String("".into()), Value::String("".into())],
+            vec![Value::Ident("".into()), Value::String("x".into())],
+        ];
+        let values = flatten_rows(&ident_ids, &rows);
+
+        for i in 0..3 {
+            assert!(!values[i].string_ptr.is_null());
+            assert_eq!(values[i].string_len, 0);
+            assert_eq!(unsafe { values[i].str() }.unwrap(), "");
+        }
+
+        free_rows(values);
+    }
+
+    #[test]
+    fn test_empty_result() {
+        let values = flatten_rows(&ident_ids, &[]);
+        assert_eq!(values.len(), 0);
+        free_rows(values);
+
+        let cursor = Box::into_raw(Box::new(Cursor::new(Box::new(ident_ids), vec![])));
+        let mut buf = vec![CValue::entity(0); 2];
+        assert_eq!(cliodb_query_next(cursor, buf.as_mut_ptr(), 1), 0);
+        cliodb_query_close(cursor);
+    }
+
+    #[test]
+    fn test_cursor_batches() {
+        let rows = (0..5)
+            .map(|i| vec![Value::Ref(Entity(i)), Value::Ident("color".into())])
+            .collect();
+        let cursor = Box::into_raw(Box::new(Cursor::new(Box::new(ident_ids), rows)));
+        let mut buf = vec![CValue::entity(0); 4];
+
+        let mut next_entity = 0;
+        for &expected in &[2, 2, 1, 0] {
+            let num_rows = cliodb_query_next(cursor, buf.as_mut_ptr(), 2);
+            assert_eq!(num_rows, expected);
+            for row in buf[..2 * num_rows].chunks(2) {
+                assert_eq!(row[0].int_val, next_entity);
+                assert_eq!(unsafe { row[1].str() }.unwrap(), "color");
+                next_entity += 1;
+            }
+        }
+
+        cliodb_query_close(cursor);
+    }
+
+    #[test]
+    fn test_intern_table() {
+        let values = intern_table(vec![("name", 1), ("color", 2)]);
+
+        assert_eq!(values.len(), 4);
+        assert_eq!(values[0].tag, ValueTag::Entity);
+        assert_eq!(values[0].int_val, 1);
+        assert_eq!(values[1].tag, ValueTag::Ident);
+        assert_eq!(unsafe { values[1].str() }.unwrap(), "name");
+        assert_eq!(values[2].int_val, 2);
+        assert_eq!(unsafe { values[3].str() }.unwrap(), "color");
+
+        free_rows(values);
+    }
+}
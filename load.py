@@ -1,7 +1,20 @@
 # Emit commands to load /usr/share/dict/words into cliodb.
 
-print('{db:ident word}')
+import sys
 
-with open('/usr/share/dict/words', 'r') as words:
-    for word in words:
-        print('{word "%s"}' % word.strip())
+TEMPL = b'{word "%s"}\n'
+# Words per write; at ~20 bytes per command this is roughly 64KB.
+CHUNK_SIZE = 4096
+
+def main():
+    out = sys.stdout.buffer
+    out.write(b'{db:ident word}\n')
+
+    with open('/usr/share/dict/words', 'rb') as words_file:
+        words = words_file.read().splitlines()
+
+    for i in range(0, len(words), CHUNK_SIZE):
+        out.write(b''.join(TEMPL % word.strip() for word in words[i:i + CHUNK_SIZE]))
+
+if __name__ == "__main__":
+    main()
@@ -54,6 +54,7 @@ mod durable_tree;
 pub use parser::{parse_input, parse_tx, parse_query, Input};
 use queries::query::{Clause, Term, Var};
 pub use queries::execution::query;
+pub use queries::query::Query;
 use index::{Comparator, Equivalent};
 use backends::KVStore;
 
@@ -425,6 +426,48 @@ pub mod tests {
         );
     }
 
+    #[test]
+    fn test_bound_query() {
+        // find ?a where (?a name ?name), with ?name bound to "Bob"
+        expect_query_result(
+            parse_query("find ?a where (?a name ?name)").unwrap()
+                .bind(vec![("name", Value::String("Bob".into()))])
+                .unwrap(),
+            Relation(
+                vec![Var::new("a")],
+                vec![vec![Value::Ref(Entity(11))]],
+            ),
+        );
+    }
+
+    #[test]
+    fn test_bound_constraint() {
+        // find ?a ?b where (?a name ?b) (< ?b ?max), with ?max bound to "Charlie"
+        expect_query_result(
+            parse_query("find ?a ?b where (?a name ?b) (< ?b ?max)").unwrap()
+                .bind(vec![("max", Value::String("Charlie".into()))])
+                .unwrap(),
+            Relation(
+                vec![Var::new("a"), Var::new("b")],
+                vec![
+                    vec![Value::Ref(Entity(11)), Value::String("Bob".into())],
+                ],
+            ),
+        );
+    }
+
+    #[test]
+    fn test_bind_find_var() {
+        let q = parse_query("find ?a where (?a name \"Bob\")").unwrap();
+        assert!(q.bind(vec![("a", Value::Ref(Entity(11)))]).is_err());
+    }
+
+    #[test]
+    fn test_bind_unknown_var() {
+        let q = parse_query("find ?a where (?a name ?b)").unwrap();
+        assert!(q.bind(vec![("c", Value::String("Bob".into()))]).is_err());
+    }
+
     #[test]
     fn test_constraint() {
         // find ?a ?b where (?a name ?b) (< ?b "Charlie")
@@ -1,6 +1,6 @@
 use im::HashMap;
 
-use {Entity, Value, Result, Ident};
+use {Entity, Value, Result, Error, Ident};
 
 #[derive(Debug, PartialEq, Eq, Clone)]
 pub struct Query {
@@ -9,6 +9,50 @@ pub struct Query {
     pub constraints: Vec<Constraint>,
 }
 
+impl Query {
+    /// Returns a copy of the query with the given vars replaced by
+    /// values, so that a query can be parsed once and then run many
+    /// times with different parameters. Vars in the find clause can't
+    /// be bound, since they have to appear in the result, and neither
+    /// can names that aren't vars in the query.
+    pub fn bind<I, S>(&self, params: I) -> Result<Query>
+    where
+        I: IntoIterator<Item = (S, Value)>,
+        S: Into<String>,
+    {
+        let env: HashMap<Var, Value> = params.into_iter()
+            .map(|(name, val)| (Var::new(name), val))
+            .collect();
+
+        if let Some(var) = self.find.iter().find(|var| env.contains_key(var)) {
+            return Err(Error(format!("cannot bind {:?}, which is in the find clause", var)));
+        }
+
+        let mut vars: Vec<Var> = self.clauses.iter().flat_map(|clause| clause.unbound_vars()).collect();
+        for constraint in &self.constraints {
+            for term in &[&constraint.left_hand_side, &constraint.right_hand_side] {
+                if let Term::Unbound(ref var) = **term {
+                    vars.push(var.clone());
+                }
+            }
+        }
+
+        if let Some(var) = env.keys().find(|var| !vars.contains(var)) {
+            return Err(Error(format!("cannot bind {:?}, which is not in the query", var)));
+        }
+
+        Ok(Query {
+            find: self.find.clone(),
+            clauses: self.clauses.iter()
+                .map(|clause| clause.substitute(&env))
+                .collect::<Result<Vec<Clause>>>()?,
+            constraints: self.constraints.iter()
+                .map(|constraint| constraint.substitute(&env))
+                .collect(),
+        })
+    }
+}
+
 /// A free logic variable
 #[derive(Debug, Hash, PartialEq, Eq, Clone)]
 pub struct Var {
@@ -133,6 +177,21 @@ pub struct Constraint {
 }
 
 impl Constraint {
+    pub fn substitute(&self, env: &HashMap<Var, Value>) -> Constraint {
+        let substitute_term = |term: &Term<Value>| match *term {
+            Term::Bound(_) => term.clone(),
+            Term::Unbound(ref var) => {
+                env.get(var).map_or(term.clone(), |val| Term::Bound(val.clone()))
+            }
+        };
+
+        Constraint {
+            comparator: self.comparator,
+            left_hand_side: substitute_term(&self.left_hand_side),
+            right_hand_side: substitute_term(&self.right_hand_side),
+        }
+    }
+
     pub fn satisfied_by(&self, binding: &HashMap<&Var, &Value>) -> bool {
         let lhs_value = match self.left_hand_side {
             Term::Bound(ref val) => val,